@@ -16,6 +16,7 @@ import cotask
 import task_share
 from mma_syd import MMA845x
 mma = MMA845x(pyb.I2C(1,pyb.I2C.CONTROLLER), 29,0)
+mma.active()
 
 
 def task1_fun(shares):
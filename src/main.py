@@ -15,7 +15,7 @@ import pyb
 import cotask
 import task_share
 from mma_syd import MMA845x
-mma = MMA845x(pyb.I2C(1,pyb.I2C.CONTROLLER, baudrate = 100000), 29,0)
+mma = MMA845x(pyb.I2C(1,pyb.I2C.CONTROLLER, baudrate = 400000), 29,0)
 
 
 def task1_fun(shares):
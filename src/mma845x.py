@@ -111,8 +111,8 @@ class MMA845x:
             self._works = True
         else:
             self._works = False
-            raise ValueError ('Unknown accelerometer device ID ' 
-                + str (self._dev_id) + ' at I2C address ' + address)
+            raise ValueError (f'Unknown MMA845x device ID 0x{self._dev_id:02X}'
+                              f' at I2C address 0x{address:02X}')
 
         # Ensure the accelerometer is in standby mode so we can configure it
         self.standby ()
@@ -139,9 +139,9 @@ class MMA845x:
         be made, one must call @c active(). """
 
         if self._works:
-            reg1 = ord (self._i2c.mem_read (1, self._addr, CTRL_REG1))
+            reg1 = ord (self.i2c.mem_read (1, self.addr, CTRL_REG1))
             reg1 &= ~0x01
-            self._i2c.mem_write (chr (reg1 & 0xFF), self._addr, CTRL_REG1)
+            self.i2c.mem_write (chr (reg1 & 0xFF), self.addr, CTRL_REG1)
 
 
     def get_ax_bits (self):
@@ -8,8 +8,11 @@ an exercise in a mechatronics course.
 @copyright GPL Version 3.0
 """
 
+import array
 import micropython
 import pyb
+import struct
+import utime
 # data is stored as 2’s complement 14-bit numbers
 
 ## The register address of the STATUS register in the MMA845x
@@ -33,6 +36,10 @@ OUT_Z_MSB = micropython.const (0x05)
 ## The register address of the OUT_Z_LSB register in the MMA845x
 OUT_Z_LSB = micropython.const (0x06)
 
+## The register address of the F_SETUP register in the MMA8451, which sets
+#  the FIFO mode and watermark; the MMA8452 has no FIFO
+F_SETUP = micropython.const (0x09)
+
 ## The register address of the WHO_AM_I register in the MMA845x
 #this identifies the part
 WHO_AM_I = micropython.const (0x0D)
@@ -68,6 +75,22 @@ RANGE_4g = micropython.const (1)
 RANGE_8g = micropython.const (2)
 
 
+@micropython.viper
+def _to_counts (buf, index: int) -> int:
+    """! Convert one MSB, LSB pair from a burst read into a signed count.
+    The data is left-aligned 14-bit two's complement, so it's shifted right
+    by two and then sign extended without branching by subtracting twice the
+    sign bit. This is compiled by the viper emitter, so the arithmetic is
+    done on machine integers rather than on Python objects.
+    @param buf A buffer holding accelerometer output register data
+    @param index The index of the MSB of the axis within @c buf
+    @return The acceleration in signed A/D conversion bits """
+
+    p = ptr8 (buf)
+    bits = ((p[index] << 8) | p[index + 1]) >> 2
+    return bits - ((bits & 0x2000) << 1)
+
+
 class MMA845x:
     """! This class implements a simple driver for MMA8451 and MMA8452
     accelerometers. These inexpensive phone accelerometers talk to the CPU 
@@ -76,19 +99,25 @@ class MMA845x:
     * Readings from all three axes can be taken in A/D bits or in g's
     * The range can be set to +/-2g, +/-4g, or +/-8g
 
+    The MMA845x supports 400 kHz fast-mode I<sup>2</sup>C. At 100 kHz the
+    time spent on the bus dominates the time taken to get a reading, so if
+    nothing else on the bus needs it slower, set the bus up at 400 kHz or
+    give the constructor a @c baudrate of 400000.
+
     There are many other functions supported by the accelerometers which could 
     be added by someone with too much time on her or his hands :P 
     
     An example of how to use this driver:
     @code
-    mma = mma845x.MMA845x (pyb.I2C (1, pyb.I2C.MASTER, baudrate = 100000), 29)
+    mma = mma845x.MMA845x (pyb.I2C (1, pyb.I2C.CONTROLLER, baudrate = 400000), 29)
     mma.active ()
     mma.get_accels ()
     @endcode 
     The example code works for an MMA8452 on a SparkFun<sup>TM</sup> breakout
     board. """
 
-    def __init__ (self, i2c, address, accel_range):
+    def __init__ (self, i2c, address, accel_range = RANGE_2g, max_age_ms = 0,
+                  baudrate = None):
         """! Initialize an MMA845x driver on the given I<sup>2</sup>C bus. The 
         I<sup>2</sup>C bus object must have already been initialized, as we're
         going to use it to get the accelerometer's WHO_AM_I code right away. 
@@ -97,6 +126,12 @@ class MMA845x:
             bus 
         @param accel_range The range of accelerations to measure; it must be
             either @c RANGE_2g, @c RANGE_4g, or @c RANGE_8g (default: 2g)
+        @param max_age_ms Readings taken less than this many milliseconds
+            ago are reused rather than read again from the accelerometer;
+            the default of 0 reads fresh data every time
+        @param baudrate If given, a @c pyb.I2C bus is reinitialized as a
+            controller at this clock rate, for example 400000 for fast mode;
+            the default of @c None leaves the bus as the caller set it up
             
             The following example sends the bytes 07 and FF to the register at internal address 5 in a
             sensor at I2C bus address 0x2A and reads a byte of data from the sensor's register at internal address 7.
@@ -108,17 +143,46 @@ class MMA845x:
         """
 
         ## The I2C driver which was created by the code which called this
-        print("init ")
-        self.i2c = pyb.I2C(1,pyb.I2C.CONTROLLER)
+        self.i2c = i2c
 
         ## The I2C bus address at which the accelerometer is located
-        self.addr = 29
+        self.addr = address
+
+        # Change the bus clock rate only if asked to. Only pyb.I2C is handled
+        # because other bus drivers' init() methods take different arguments
+        if baudrate is not None and isinstance (i2c, pyb.I2C):
+            i2c.init (pyb.I2C.CONTROLLER, baudrate = baudrate)
         
-        ##set up accelerometer range?
+        ## The measurement range, one of @c RANGE_2g, @c RANGE_4g, or
+        #  @c RANGE_8g; it's changed with @c set_range()
         self.accel_range = RANGE_2g
 
-        # Request the WHO_AM_I device ID byte from the accelerometer        
-        self._dev_id = ord (i2c.mem_read (1, address, WHO_AM_I))
+        # The size of one A/D count in g's for the measurement range, and
+        # of one unit of the raw left-aligned register data
+        self._g_per_lsb = 2.0 / 8192.0
+        self._g_per_raw = self._g_per_lsb / 4
+
+        # Buffers are allocated once here and reused for every transfer so
+        # that taking readings doesn't churn the heap. The receive buffer
+        # holds the latest XYZ reading and the transmit buffer holds a byte
+        # for single register writes
+        self._rxbuf = bytearray (6)
+        self._tx1 = bytearray (1)
+
+        # Time at which the receive buffer was last filled with a reading,
+        # which only means something once a reading has been taken
+        self._last_ts = 0
+        self._cache_valid = False
+        self._max_age_ms = max_age_ms
+
+        # Request the WHO_AM_I device ID byte from the accelerometer. The
+        # XYZ_DATA_CFG register comes right after it, so it's read in the
+        # same transaction and set_range() can skip rewriting an unchanged
+        # range
+        probe = bytearray (2)
+        i2c.mem_read (probe, address, WHO_AM_I)
+        self._dev_id = probe[0]
+        self._data_cfg = probe[1]
         #self._dev_id = ord(self.i2c.mem_read (1, self.addr, WHO_AM_I)) #bus address, internal address
         
         # The WHO_AM_I codes from MMA8451Q's and MMA8452Q's are recognized
@@ -127,25 +191,89 @@ class MMA845x:
             self._works = True
         else:
             self._works = False
-            raise ValueError ('Unknown accelerometer device ID ' 
-                + str (self._dev_id) + ' at I2C address ' + address)
+            raise ValueError (f'Unknown MMA845x device ID 0x{self._dev_id:02X}'
+                              f' at I2C address 0x{address:02X}')
 
         # Ensure the accelerometer is in standby mode so we can configure it
         #SYSMOD = 00, set CTRL_REG1 (?)
         #I think this is default, but:
         #SYSMOD = micropython.const(0x0B)
-        
-        self.standby()
+
+        # The accelerometer may still be active, for example after a soft
+        # reboot, and only the ACTIVE bit of CTRL_REG1 can be changed in
+        # active mode. Clearing CTRL_REG1 on its own first puts it in standby
+        self._ctrl_reg1 = 0x00
+        self._tx1[0] = self._ctrl_reg1
+        self.i2c.mem_write (self._tx1, address, CTRL_REG1)
+
+        # CTRL_REG1 to CTRL_REG5 are consecutive registers, so now that the
+        # accelerometer is in standby they're set in one block write to their
+        # power-on defaults. Since all of CTRL_REG1 is written, a copy of it
+        # is kept so that switching between active and standby modes never
+        # needs to read the register back
+        self.i2c.mem_write (bytearray ((self._ctrl_reg1, 0, 0, 0, 0)),
+                            address, CTRL_REG1)
+
+        # The FIFO of an MMA8451 may have been left on, for example by a
+        # program run before a soft reboot, so it's turned off to get newest
+        # samples from the output registers and data-ready flags from
+        # STATUS_REG
+        self._fifo_on = False
+        if self._dev_id == 0x1A:
+            self._tx1[0] = 0x00
+            self.i2c.mem_write (self._tx1, address, F_SETUP)
         
 
         # Set the acceleration range to the given one if it's legal
-        self.set_range(self.accel_range)
-        
-    def set_range(self, accel_range):
-        if accel_range != micropython.const(0) | micropython.const(1) | micropython.const(2):
-            print("uh oh")
-        else:
-            print(accel_range)
+        self.set_range (accel_range)
+
+
+    def set_range (self, accel_range):
+        """! Set the range of accelerations the MMA845x measures. The range
+        can only be changed in standby mode, so if the accelerometer is
+        active it's put in standby for the change and then made active again.
+        The scale factor used to convert readings to g's is computed here so
+        it needn't be recomputed for each reading. If the accelerometer is
+        already set to the given range, nothing is sent to it.
+        @param accel_range The range of accelerations to measure; it must be
+            either @c RANGE_2g, @c RANGE_4g, or @c RANGE_8g
+        """
+
+        if accel_range not in (RANGE_2g, RANGE_4g, RANGE_8g):
+            raise ValueError (f'Illegal MMA845x range {accel_range}')
+
+        # Only the FS bits which select the range are changed
+        data_cfg = (self._data_cfg & ~0x03) | accel_range
+        if data_cfg != self._data_cfg:
+            was_active = self._ctrl_reg1 & 0x01
+            if was_active:
+                self.standby ()
+
+            self._tx1[0] = data_cfg
+            self.i2c.mem_write (self._tx1, self.addr, XYZ_DATA_CFG)
+            self._data_cfg = data_cfg
+
+            if was_active:
+                self.active ()
+
+        self.accel_range = accel_range
+
+        # A cached reading holds counts taken in the old range, so it mustn't
+        # be scaled with the new range's factor
+        self._cache_valid = False
+
+        # The full scale of +/-2, 4, or 8 g's spans 8192 counts each way
+        self._g_per_lsb = (2.0 * (1 << accel_range)) / 8192.0
+
+        # The two bits below a 14-bit reading are always zero, so raw 16-bit
+        # register values are scaled by a quarter of the factor, which gives
+        # exactly the same result as shifting right by two first. This is
+        # the only part of taking a reading which depends on the range, so
+        # folding it into one constant here is all the specialization the
+        # sampling methods need
+        self._g_per_raw = self._g_per_lsb / 4
+
+
     def active (self):
         """! Put the MMA845x into active mode so that it takes data. In active
         mode, the accelerometer's settings can't be messed with. Active mode
@@ -153,9 +281,9 @@ class MMA845x:
         """
 
         if self._works:
-            reg1 = ord (self.i2c.mem_read (1, self.addr, CTRL_REG1))
-            reg1 |= 0x01
-            self.i2c.mem_write (chr (reg1), self.addr, CTRL_REG1)
+            self._ctrl_reg1 |= 0x01
+            self._tx1[0] = self._ctrl_reg1
+            self.i2c.mem_write (self._tx1, self.addr, CTRL_REG1)
 
 
     def standby (self):
@@ -164,26 +292,205 @@ class MMA845x:
         be made, one must call @c active(). """
 
         if self._works:
-            reg1 = ord (self.i2c.mem_read (1, self.addr, CTRL_REG1)) #bus address, internal address
-            reg1 &= ~0x01
-            self.i2c.mem_write (chr (reg1 & 0xFF), self.addr, CTRL_REG1)
+            self._ctrl_reg1 &= ~0x01 & 0xFF
+            self._tx1[0] = self._ctrl_reg1
+            self.i2c.mem_write (self._tx1, self.addr, CTRL_REG1) #bus address, internal address
+
+
+    @micropython.native
+    def _read_xyz_raw (self):
+        """! Read the X, Y, and Z output registers in one I<sup>2</sup>C
+        transaction. The MMA845x auto-increments its register pointer, so a
+        6-byte read starting at @c OUT_X_MSB returns the MSB and LSB of all
+        three axes. If the last reading is younger than the @c max_age_ms
+        given to the constructor, it is returned without using the bus.
+        @return The driver's 6-byte receive buffer holding X, Y, and Z as
+            MSB, LSB pairs; it is overwritten by the next read """
+
+        if self._max_age_ms:
+            now = utime.ticks_ms ()
+            if (self._cache_valid
+                    and utime.ticks_diff (now, self._last_ts)
+                        < self._max_age_ms):
+                return self._rxbuf
+
+        self.i2c.mem_read (self._rxbuf, self.addr, OUT_X_MSB)
+
+        # The buffer only counts as a reading once the transfer has worked;
+        # if it raised an exception, the next call tries the bus again
+        if self._max_age_ms:
+            self._last_ts = now
+            self._cache_valid = True
+        return self._rxbuf
+
+
+    def read_raw_into (self, buf):
+        """! Read the raw X, Y, and Z output registers into a buffer supplied
+        by the caller. Nothing is allocated and no conversion is done, so this
+        suits high rate logging into a preallocated buffer, for example a
+        @c memoryview slice of a larger circular buffer. Each axis is stored
+        as a left-aligned 14-bit two's complement MSB, LSB pair.
+        @param buf A writable buffer of 6 bytes which receives the data
+        """
+
+        self.i2c.mem_read (buf, self.addr, OUT_X_MSB)
+
+
+    @micropython.native
+    def read_if_ready (self, buf7):
+        """! Get all three accelerations, but only if the MMA845x has new
+        data. One 7-byte burst read starting at @c STATUS_REG gets the status
+        byte along with the X, Y, and Z output registers, so checking for new
+        data costs no extra I<sup>2</sup>C transaction. This can't be used
+        while the FIFO is on, because then the register at @c STATUS_REG
+        holds the FIFO status instead of the data-ready flags.
+        @param buf7 A writable buffer of 7 bytes which receives the status
+            byte followed by the raw X, Y, and Z data
+        @return A tuple containing the X, Y, and Z accelerations in g's, or
+            @c None if no new data was ready """
+
+        if self._fifo_on:
+            raise ValueError ('read_if_ready() needs the FIFO to be off')
+
+        self.i2c.mem_read (buf7, self.addr, STATUS_REG)
+
+        # The ZYXDR bit is set when a new set of X, Y, and Z data is ready
+        if not buf7[0] & 0x08:
+            return None
+
+        x, y, z = struct.unpack_from ('>hhh', buf7, 1)
+        s = self._g_per_raw
+        return (x * s, y * s, z * s)
+
+
+    def get_g_per_bit (self):
+        """! Get the size of one A/D conversion bit in g's for the range
+        which has been set. Raw readings such as those from @c read_batch()
+        are multiplied by this to convert them to g's.
+        @return The acceleration in g's represented by one A/D bit """
+
+        return self._g_per_lsb
+
+
+    @micropython.native
+    def read_batch (self, n, out = None):
+        """! Take a batch of readings and put them into an array of signed
+        16-bit numbers which can be processed all at once, for example
+        scaled by the factor from @c get_g_per_bit(). Readings are taken
+        back to back as quickly as the bus allows, bypassing the
+        @c max_age_ms cache; the driver's receive buffer is used for the
+        transfers, so any cached reading is dropped. Nothing is allocated
+        when @c out is given.
+        @param n The number of readings to take
+        @param out An @c array.array of type code @c 'h' holding at least
+            @c 3*n items to be filled, or @c None to create a new one
+        @return The array holding the readings in A/D bits, in the order
+            X, Y, Z, X, Y, Z, ... """
+
+        if out is None:
+            # Zero-filled storage is made from bytes rather than by
+            # converting 3n Python integers one at a time
+            out = array.array ('h', bytes (6 * n))
+
+        # Each transfer overwrites the receive buffer, which then no longer
+        # holds the reading its timestamp belongs to
+        self._cache_valid = False
+
+        buf = self._rxbuf
+        for i in range (0, 3 * n, 3):
+            self.i2c.mem_read (buf, self.addr, OUT_X_MSB)
+            x, y, z = struct.unpack_from ('>hhh', buf)
+            out[i] = x >> 2
+            out[i + 1] = y >> 2
+            out[i + 2] = z >> 2
+
+        return out
+
+
+    def enable_fifo (self, watermark = 16):
+        """! Turn on the 32-sample FIFO of an MMA8451 in circular buffer
+        mode, in which the oldest samples are overwritten once it's full.
+        Samples can then be taken out many at a time with @c read_fifo(),
+        which spreads the I<sup>2</sup>C overhead across the samples. The
+        FIFO mode can only be changed in standby mode, so if the
+        accelerometer is active it's put in standby for the change and then
+        made active again. While the FIFO is on, reads of the output
+        registers, including those by @c get_accels(), take the oldest
+        sample out of the FIFO rather than giving the newest one, and
+        @c read_if_ready() can't be used; @c disable_fifo() turns it off.
+        @param watermark The number of samples, from 0 to 32, at which the
+            FIFO watermark flag is set; 0 turns off the watermark flag
+        """
+
+        if self._dev_id != 0x1A:
+            raise ValueError ('Only the MMA8451 has a FIFO')
+        if not 0 <= watermark <= 32:
+            raise ValueError (f'Illegal MMA8451 FIFO watermark {watermark}')
+
+        # F_MODE = 01 in the top two bits selects circular buffer mode
+        self._set_fifo (0x40 | watermark)
+
+
+    def disable_fifo (self):
+        """! Turn off the FIFO of an MMA8451 so that reads of the output
+        registers give the newest sample again. As with @c enable_fifo(),
+        the accelerometer is put in standby for the change if it's active.
+        """
+
+        if self._dev_id != 0x1A:
+            raise ValueError ('Only the MMA8451 has a FIFO')
+
+        self._set_fifo (0x00)
+
+
+    def _set_fifo (self, f_setup):
+        """! Write the MMA8451's @c F_SETUP register, going to standby mode
+        for the write if the accelerometer is active.
+        @param f_setup The value for @c F_SETUP, whose top two bits select
+            the FIFO mode and whose low six bits set the watermark
+        """
+
+        was_active = self._ctrl_reg1 & 0x01
+        if was_active:
+            self.standby ()
+
+        self._tx1[0] = f_setup
+        self.i2c.mem_write (self._tx1, self.addr, F_SETUP)
+        self._fifo_on = bool (f_setup & 0xC0)
+
+        # Output register reads come from the FIFO only when it's on, so a
+        # cached reading taken before the change is dropped
+        self._cache_valid = False
+
+        if was_active:
+            self.active ()
+
+
+    def read_fifo (self, out_buf):
+        """! Take samples out of the MMA8451's FIFO in one burst read. In
+        FIFO mode the register pointer wraps from @c OUT_Z_LSB back to
+        @c OUT_X_MSB, so a long read starting at @c OUT_X_MSB returns
+        consecutive samples, each as raw X, Y, and Z MSB, LSB pairs as from
+        @c read_raw_into(). The FIFO must have been turned on with
+        @c enable_fifo(), and the caller should read no more samples than
+        the FIFO holds, for example by reading a watermark's worth of
+        samples once the watermark flag is set.
+        @param out_buf A writable buffer whose length is 6 times the number
+            of samples to be read
+        """
+
+        if self._dev_id != 0x1A:
+            raise ValueError ('Only the MMA8451 has a FIFO')
+
+        self.i2c.mem_read (out_buf, self.addr, OUT_X_MSB)
 
 
     def get_ax_bits (self):
         """! Get the X acceleration from the accelerometer in A/D bits and 
         return it.
         @return The measured X acceleration in A/D conversion bits """
-        #reads two bytes from register address
-        #accel address, then register address
-        #i think we only need MSB
-        #set active mode
-        
-        self.active()
-        
-        accel_x_hi = self.i2c.mem_read(2, self.addr, OUT_X_MSB)
-        #accel_x_hi is a byte array 
-        
-        return (accel_x_hi)
+
+        return _to_counts (self._read_xyz_raw (), 0)
        
     
     def get_ay_bits (self):
@@ -191,8 +498,7 @@ class MMA845x:
         return it.
         @return The measured Y acceleration in A/D conversion bits """
 
-        print ('MMA845x clueless about Y acceleration')
-        return 0
+        return _to_counts (self._read_xyz_raw (), 2)
 
 
     def get_az_bits (self):
@@ -200,33 +506,16 @@ class MMA845x:
         return it.
         @return The measured Z acceleration in A/D conversion bits """
 
-        print ('MMA845x clueless about Z acceleration')
-        return 0
+        return _to_counts (self._read_xyz_raw (), 4)
 
 
     def get_ax (self):
         """! Get the X acceleration from the accelerometer in g's, assuming
-        that the accelerometer was correctly calibrated at the factory.
-        @return The measured X acceleration in g's
-        
-        As the range is -1 to +1, this would be a total of 2g.  Or 2,000 Milli-Gs.
-        The output is 16 bits. 16 bits equals 65,535.   This means we can get 65,535
-        different readings for the range  between -2 and +2. (or -2,000 MilliGs and +2,000 MilliGs)
-        2,000 MilliGs / 65,535 = 0.0305
-        Each time the LSB changes by one, the value changes by 0.0305"""
-        #16384 for 14 bits
-        x_data = self.get_ax_bits()
-        MSB = int.from_bytes(x_data, 'big', True)
-        
-        if MSB < 32768:
-            ax_bits = MSB
-        else:
-            ax_bits = MSB - 65536
-            
-        #MSB = int.from_bytes(x_data, 'big', True)
-            
-        ax_bits_new = ax_bits/17000
-        return(ax_bits_new)
+        that the accelerometer was correctly calibrated at the factory. The
+        measurement is adjusted for the range (2g, 4g, or 8g) setting.
+        @return The measured X acceleration in g's """
+
+        return self.get_ax_bits () * self._g_per_lsb
 
 
     def get_ay (self):
@@ -235,8 +524,7 @@ class MMA845x:
         measurement is adjusted for the range (2g, 4g, or 8g) setting.
         @return The measured Y acceleration in g's """
 
-        print ('MMA845x uncalibrated Y')
-        return 0
+        return self.get_ay_bits () * self._g_per_lsb
 
 
     def get_az (self):
@@ -245,16 +533,23 @@ class MMA845x:
         measurement is adjusted for the range (2g, 4g, or 8g) setting.
         @return The measured Z acceleration in g's """
 
-        print ('MMA845x uncalibrated Z')
-        return 0
+        return self.get_az_bits () * self._g_per_lsb
 
 
+    @micropython.native
     def get_accels (self):
         """! Get all three accelerations from the MMA845x accelerometer. The
-        measurement is adjusted for the range (2g, 4g, or 8g) setting.
+        measurement is adjusted for the range (2g, 4g, or 8g) setting. This
+        method is compiled to machine code by the native emitter, so parsing
+        and scaling the readings costs little beyond the bus transfer.
         @return A tuple containing the X, Y, and Z accelerations in g's """
 
-        return (self.get_ax (), self.get_ay (), self.get_az ())
+        # The data is parsed as big-endian signed 16-bit numbers in one call
+        # to the struct module's C code, then scaled by the factor which
+        # set_range() computed for the raw left-aligned values
+        x, y, z = struct.unpack_from ('>hhh', self._read_xyz_raw ())
+        s = self._g_per_raw
+        return (x * s, y * s, z * s)
 
 
     def __repr__ (self):
@@ -266,10 +561,10 @@ class MMA845x:
         if not self._works:
             return ('No working MMA845x at I2C address ' + str (self.addr))
         else:
-            reg1 = ord (self.i2c.mem_read (1, self.addr, CTRL_REG1))
+            reg1 = self._ctrl_reg1
             diag_str = 'MMA845' + str (self._dev_id >> 4) \
                 + ': I2C address ' + hex (self.addr) \
-                + ', Range=' + str (1 << (self._range + 1)) + 'g, Mode='
+                + ', Range=' + str (1 << (self.accel_range + 1)) + 'g, Mode='
             diag_str += 'active' if reg1 & 0x01 else 'standby'
 
             return diag_str